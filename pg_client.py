@@ -0,0 +1,36 @@
+import asyncio
+import asyncpg
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# DSN Postgres langsung (lewat pgbouncer/Supavisor mode session), BUKAN URL
+# PostgREST. Dipakai jalur panas webhook supaya tidak bayar lapisan HTTP+JSON.
+# Wajib di-set: tanpa ini asyncpg jatuh ke default libpq (localhost) dan
+# record_sales_journal gagal diam-diam setelah webhook terlanjur dijawab 200.
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL")
+if not SUPABASE_DB_URL:
+    raise RuntimeError(
+        "SUPABASE_DB_URL belum di-set. Isi dengan DSN Postgres langsung "
+        "(postgresql://...), lihat .env.example."
+    )
+
+_pool = None
+_pool_lock = asyncio.Lock()
+
+async def get_pg_pool() -> asyncpg.Pool:
+    """Pool koneksi asyncpg untuk jalur panas webhook (dibuat sekali, lazy)."""
+    global _pool
+    if _pool is None:
+        # Lock supaya dua request pertama yang datang bersamaan tidak
+        # sama-sama lolos cek None dan membuat pool ganda
+        async with _pool_lock:
+            if _pool is None:
+                _pool = await asyncpg.create_pool(
+                    SUPABASE_DB_URL,
+                    min_size=5,
+                    max_size=20,
+                    statement_cache_size=256,
+                )
+    return _pool
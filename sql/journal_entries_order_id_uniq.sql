@@ -0,0 +1,7 @@
+-- Satu order hanya boleh punya satu jurnal penjualan REGULAR.
+-- Index unik ini yang menjadi penjaga idempotency di level database;
+-- aplikasi tinggal INSERT dengan ON CONFLICT DO NOTHING (upsert
+-- ignore_duplicates) tanpa SELECT-then-INSERT yang bisa balapan.
+create unique index if not exists journal_entries_order_id_uniq
+    on journal_entries (order_id)
+    where entry_type = 'REGULAR';
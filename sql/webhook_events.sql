@@ -0,0 +1,13 @@
+-- Catatan setiap notifikasi Midtrans yang pernah diterima. transaction_id
+-- mengidentifikasi PEMBAYARAN, bukan event: pending, settlement, refund,
+-- dan cancel-setelah-settle untuk pembayaran yang sama membawa
+-- transaction_id yang sama. Karena itu dedupe memakai kunci komposit
+-- (transaction_id, status) supaya hanya pengiriman ulang status yang sama
+-- yang dianggap duplikat, sementara transisi status berikutnya tetap diproses.
+create table if not exists webhook_events (
+    transaction_id text,
+    status text,
+    order_id bigint,
+    received_at timestamptz default now(),
+    primary key (transaction_id, status)
+);
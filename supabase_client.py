@@ -1,4 +1,6 @@
-from supabase import create_client
+import asyncio
+from supabase import create_client, acreate_client
+from supabase.lib.client_options import ClientOptions, AsyncClientOptions
 import os
 from dotenv import load_dotenv
 
@@ -7,4 +9,32 @@ load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Catatan pooling: ClientOptions di supabase==2.15.1 belum menerima httpx
+# client custom, tapi httpx yang dipakai postgrest-py sudah keep-alive pool
+# secara default (Limits: 20 koneksi idle / 100 total), jadi koneksi TLS ke
+# PostgREST tetap dipakai ulang antar-call. Yang kita atur di sini timeout-nya.
+supabase = create_client(
+    SUPABASE_URL,
+    SUPABASE_KEY,
+    options=ClientOptions(postgrest_client_timeout=10),
+)
+
+# Client async untuk jalur webhook: query-nya di-await sehingga tidak
+# memblokir event loop seperti client sync di atas. Dibuat sekali secara
+# lazy (acreate_client harus di-await, jadi tidak bisa di level modul).
+_async_client = None
+_async_client_lock = asyncio.Lock()
+
+async def get_async_supabase():
+    global _async_client
+    if _async_client is None:
+        # Lock supaya dua request pertama yang datang bersamaan tidak
+        # sama-sama lolos cek None dan membuat client ganda
+        async with _async_client_lock:
+            if _async_client is None:
+                _async_client = await acreate_client(
+                    SUPABASE_URL,
+                    SUPABASE_KEY,
+                    options=AsyncClientOptions(postgrest_client_timeout=10),
+                )
+    return _async_client
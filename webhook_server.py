@@ -1,138 +1,265 @@
+import asyncio
+import hashlib
+import hmac
+import logging
 import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+import asyncpg
+import orjson
 import uvicorn
-from fastapi import FastAPI, Request, HTTPException
-from supabase_client import supabase 
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
+from fastapi.responses import ORJSONResponse
+from pg_client import get_pg_pool
+from supabase_client import get_async_supabase
 from dotenv import load_dotenv
 from datetime import date 
 
 load_dotenv()
 
-app = FastAPI(title="Midtrans Webhook Listener & Accounting Processor")
+app = FastAPI(
+    title="Midtrans Webhook Listener & Accounting Processor",
+    default_response_class=ORJSONResponse,
+)
 MIDTRANS_SERVER_KEY = os.getenv("MIDTRANS_SERVER_KEY")
 
+# Logging non-blocking menggantikan print(): print memegang lock stdio dan
+# flush sinkron, yang men-serialisasi worker di bawah load. Record masuk ke
+# queue dan di-flush oleh QueueListener di thread terpisah, jadi IO log tidak
+# pernah memblokir event loop. Level pesan detail diatur lewat LOG_LEVEL.
+logger = logging.getLogger("webhook")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+_log_queue = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+logger.addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, _stream_handler)
+_log_listener.start()
+
+# Status Midtrans yang kita anggap final (frozenset: lookup O(1) tanpa
+# alokasi list baru di tiap request)
+SETTLED = frozenset({"capture", "settlement"})
+FAILED = frozenset({"deny", "expire", "cancel"})
+
+# Batas mulai pakai COPY biner untuk insert batch: di bawah ini overhead
+# setup COPY lebih mahal daripada executemany biasa
+COPY_THRESHOLD = 16
+
 # ===============================================
 # FUNGSI AKUNTANSI & INVENTORY
 # ===============================================
 
-def record_sales_journal(order_id: int):
+async def record_sales_journal(order_id: int):
     """
     Mencatat Jurnal Penjualan, HPP, dan Mengurangi Stok Fisik.
+    Jalur panas ini memakai asyncpg langsung ke Postgres (prepared statement,
+    tanpa lapisan HTTP+JSON PostgREST); semua tulisan dalam satu transaksi
+    SERIALIZABLE, dengan retry + jitter saat transaksi bentrok.
     """
     try:
-        # 1. CEK DUPLIKASI (IDEMPOTENCY)
-        existing = supabase.table("journal_entries").select("id").eq("order_id", order_id).execute()
-        if existing.data:
-            print(f"INFO: Jurnal untuk Order {order_id} sudah ada. Skip.")
-            return True
-
-        # 2. AMBIL DATA PESANAN & PRODUK
-        # Menggunakan query spesifik untuk menghindari error relasi ganda
-        # Jika nanti error relasi muncul lagi, ganti 'products(*)' dengan 'products!order_items_product_id_fkey(*)'
-        order_response = supabase.table("orders").select(
-            "*, order_items(*, products(*))"
-        ).eq("id", order_id).execute()
-        
-        if not order_response.data:
-            print(f"ERROR: Order {order_id} tidak ditemukan.")
-            return False
+        pool = await get_pg_pool()
+        for attempt in range(3):
+            try:
+                async with pool.acquire() as conn:
+                    async with conn.transaction(isolation="serializable"):
+                        return await _record_sale_tx(conn, order_id)
+            except asyncpg.SerializationError:
+                if attempt == 2:
+                    raise
+                await asyncio.sleep(0.05 + random.random() * 0.15)
 
-        order = order_response.data[0]
-        total_revenue = order["total_amount"]
-        
-        CASH_ACCOUNT = '1-1100'
-        SALES_ACCOUNT = '4-1100'
-        
-        lines = []
-        movements_to_insert = []
-
-        # 3. BUAT HEADER JURNAL
-        journal = supabase.table("journal_entries").insert({
-            "order_id": order_id,
-            "transaction_date": str(date.today()),
-            "description": f"Jurnal Penjualan Tunai Order ID: {order_id}",
-            "user_id": order.get("user_id"),
-            "entry_type": "REGULAR" 
-        }).execute().data[0]
-        journal_id = journal["id"]
-
-        # 4. DEBIT KAS & KREDIT PENJUALAN
-        lines.append({"journal_id": journal_id, "account_code": CASH_ACCOUNT, "debit_amount": total_revenue, "credit_amount": 0})
-        lines.append({"journal_id": journal_id, "account_code": SALES_ACCOUNT, "debit_amount": 0, "credit_amount": total_revenue})
-        
-        # 5. LOOP BARANG: JURNAL HPP & UPDATE STOK
-        for item in order["order_items"]:
-            product_id = item["product_id"]
-            quantity_sold = item["quantity"]
-            
-            # Handling jika data produk tidak terbaca (Safe Mode)
-            product_data = item.get("products")
-            if not product_data:
-                print(f"⚠️ WARN: Produk ID {product_id} tidak ditemukan relasinya. Stok tidak ter-update.")
-                product_data = {}
-            
-            # Ambil data cost & akun
-            cost_price = product_data.get("cost_price", 0) or 0
-            inventory_acc = product_data.get("inventory_account_code", '1-1200')
-            hpp_acc = product_data.get("hpp_account_code", '5-1100')
-            
-            # Ambil STOK SAAT INI (Penting!)
-            current_stock = product_data.get("stock")
-            if current_stock is None: 
-                current_stock = 0
-
-            if quantity_sold > 0:
-                cost_of_sale = quantity_sold * cost_price
-
-                # A. Jurnal HPP
-                if cost_price > 0:
-                    lines.append({"journal_id": journal_id, "account_code": hpp_acc, "debit_amount": cost_of_sale, "credit_amount": 0})
-                    lines.append({"journal_id": journal_id, "account_code": inventory_acc, "debit_amount": 0, "credit_amount": cost_of_sale})
-
-                # B. Catat Inventory Movement (Hanya History)
-                movements_to_insert.append({
-                    "product_id": product_id,
-                    "movement_date": str(date.today()), 
-                    "movement_type": "ISSUE", 
-                    "quantity_change": -quantity_sold, 
-                    "unit_cost": cost_price,
-                    "reference_id": f"ORDER-{order_id}",
-                })
-                
-                # C. [LOGIKA BARU] UPDATE STOK FISIK DI DATABASE
-                # Ini adalah bagian yang HILANG di kode lama Anda
-                if product_data:
-                    new_stock = current_stock - quantity_sold
-                    # Cegah stok minus
-                    if new_stock < 0: new_stock = 0
-                    
-                    # Eksekusi Update ke Supabase
-                    upd = supabase.table("products").update({"stock": new_stock}).eq("id", product_id).execute()
-                    print(f"✅ Update Stok Produk {product_id}: {current_stock} -> {new_stock}")
-
-        # 6. SIMPAN SEMUA PERUBAHAN KE DB
-        if lines:
-            supabase.table("journal_lines").insert(lines).execute()
-        
-        if movements_to_insert:
-            supabase.table("inventory_movements").insert(movements_to_insert).execute()
+    except Exception:
+        logger.exception(f"FATAL ERROR Order {order_id}")
+        return False
 
-        print(f"SUCCESS: Order {order_id} selesai. (Jurnal Terbentuk & Stok Terupdate)")
-        return True
 
-    except Exception as e:
-        print(f"FATAL ERROR Order {order_id}: {e}")
+async def _record_sale_tx(conn, order_id: int):
+    """Isi transaksi record_sales_journal; dipanggil di dalam conn.transaction()."""
+    # SERIALISASI PER-ORDER: dua retry Midtrans simultan untuk order yang sama
+    # antre di advisory lock ini (lepas otomatis saat COMMIT/ROLLBACK), order
+    # berbeda tetap jalan paralel. Index unik tetap jadi backstop kebenaran.
+    await conn.execute("SELECT pg_advisory_xact_lock($1::bigint)", order_id)
+
+    # 1. AMBIL DATA PESANAN & PRODUK (hanya kolom yang dipakai)
+    order = await conn.fetchrow(
+        "SELECT total_amount, user_id FROM orders WHERE id = $1", order_id
+    )
+    if order is None:
+        logger.error(f"Order {order_id} tidak ditemukan.")
         return False
 
+    items = await conn.fetch(
+        """
+        SELECT oi.product_id, oi.quantity, p.id AS pid,
+               p.cost_price, p.inventory_account_code, p.hpp_account_code
+        FROM order_items oi
+        LEFT JOIN products p ON p.id = oi.product_id
+        WHERE oi.order_id = $1
+        """,
+        order_id,
+    )
+
+    total_revenue = order["total_amount"]
+
+    CASH_ACCOUNT = '1-1100'
+    SALES_ACCOUNT = '4-1100'
+
+    # 2. HEADER JURNAL (sekaligus cek duplikasi lewat index unik
+    # journal_entries_order_id_uniq: ON CONFLICT DO NOTHING -> id NULL)
+    today = date.today()
+    journal_id = await conn.fetchval(
+        """
+        INSERT INTO journal_entries (order_id, transaction_date, description, user_id, entry_type)
+        VALUES ($1, $2, $3, $4, 'REGULAR')
+        ON CONFLICT (order_id) WHERE entry_type = 'REGULAR' DO NOTHING
+        RETURNING id
+        """,
+        order_id, today, f"Jurnal Penjualan Tunai Order ID: {order_id}", order["user_id"],
+    )
+    if journal_id is None:
+        logger.info(f"Jurnal untuk Order {order_id} sudah ada. Skip.")
+        return True
+
+    lines = []
+    movements_to_insert = []
+    # product_id -> total qty. Diagregasi di sini karena UPDATE ... FROM hanya
+    # menerapkan SATU baris join per baris target; produk yang muncul di
+    # beberapa baris order harus dijumlah dulu agar tidak ada decrement hilang.
+    stock_deltas = {}
+
+    # Hoist nilai yang konstan selama satu order keluar dari loop:
+    # reference dan alias .append (hindari lookup atribut per baris)
+    ref = f"ORDER-{order_id}"
+    append_line = lines.append
+    append_mv = movements_to_insert.append
+
+    # 3. DEBIT KAS & KREDIT PENJUALAN
+    append_line((journal_id, CASH_ACCOUNT, total_revenue, 0))
+    append_line((journal_id, SALES_ACCOUNT, 0, total_revenue))
+
+    # 4. LOOP BARANG: JURNAL HPP & UPDATE STOK
+    for item in items:
+        product_id = item["product_id"]
+        quantity_sold = item["quantity"]
+
+        # Handling jika data produk tidak terbaca (Safe Mode)
+        product_found = item["pid"] is not None
+        if not product_found:
+            logger.warning(f"Produk ID {product_id} tidak ditemukan relasinya. Stok tidak ter-update.")
+
+        # Ambil data cost & akun
+        cost_price = item["cost_price"] or 0
+        inventory_acc = item["inventory_account_code"] or '1-1200'
+        hpp_acc = item["hpp_account_code"] or '5-1100'
+
+        if quantity_sold > 0:
+            cost_of_sale = quantity_sold * cost_price
+
+            # A. Jurnal HPP
+            if cost_price > 0:
+                append_line((journal_id, hpp_acc, cost_of_sale, 0))
+                append_line((journal_id, inventory_acc, 0, cost_of_sale))
+
+            # B. Catat Inventory Movement (Hanya History)
+            append_mv((product_id, today, "ISSUE", -quantity_sold, cost_price, ref))
+
+            # C. KUMPULKAN ITEM UNTUK UPDATE STOK BATCH
+            if product_found:
+                stock_deltas[product_id] = stock_deltas.get(product_id, 0) + quantity_sold
+
+    # 5. SIMPAN SEMUA PERUBAHAN KE DB (satu transaksi). Order besar memakai
+    # COPY biner (tanpa parsing SQL per baris, 5-10x lebih cepat untuk batch
+    # panjang); order kecil tetap executemany karena setup COPY-nya tidak balik modal.
+    if len(lines) > COPY_THRESHOLD:
+        await conn.copy_records_to_table(
+            "journal_lines",
+            records=lines,
+            columns=["journal_id", "account_code", "debit_amount", "credit_amount"],
+        )
+    else:
+        await conn.executemany(
+            "INSERT INTO journal_lines (journal_id, account_code, debit_amount, credit_amount) "
+            "VALUES ($1, $2, $3, $4)",
+            lines,
+        )
+
+    if len(movements_to_insert) > COPY_THRESHOLD:
+        await conn.copy_records_to_table(
+            "inventory_movements",
+            records=movements_to_insert,
+            columns=["product_id", "movement_date", "movement_type",
+                     "quantity_change", "unit_cost", "reference_id"],
+        )
+    elif movements_to_insert:
+        await conn.executemany(
+            "INSERT INTO inventory_movements (product_id, movement_date, movement_type, "
+            "quantity_change, unit_cost, reference_id) VALUES ($1, $2, $3, $4, $5, $6)",
+            movements_to_insert,
+        )
+
+    # Pengurangan stok tetap atomik di server: GREATEST(stock - qty, 0)
+    if stock_deltas:
+        await conn.execute(
+            """
+            UPDATE products p
+            SET stock = GREATEST(p.stock - x.qty, 0)
+            FROM (SELECT unnest($1::int[]) AS id, unnest($2::int[]) AS qty) x
+            WHERE p.id = x.id
+            """,
+            list(stock_deltas.keys()), list(stock_deltas.values()),
+        )
+
+    logger.info(f"Order {order_id} selesai. (Jurnal {journal_id} Terbentuk & Stok Terupdate)")
+    return True
+
 # ===============================================
 # MIDTRANS WEBHOOK
 # ===============================================
 
+async def _record_webhook_event(supabase, transaction_id, order_id_int, transaction_status):
+    """
+    Catat event ke webhook_events SETELAH pemrosesan sukses (at-least-once):
+    kalau pemrosesan gagal, event tidak tercatat dan retry Midtrans akan
+    memproses ulang — aman karena jurnal (index unik + advisory lock) dan
+    update status orders sama-sama idempotent. True = pengiriman ulang.
+    """
+    if not transaction_id:
+        return False
+    event_response = await supabase.table("webhook_events").upsert({
+        "transaction_id": transaction_id,
+        "order_id": order_id_int,
+        "status": transaction_status,
+    }, on_conflict="transaction_id,status", ignore_duplicates=True).execute()
+    if not event_response.data:
+        logger.info(f"Event {transaction_id}/{transaction_status} duplikat.")
+        return True
+    return False
+
+
 @app.post("/midtrans/notification")
-async def midtrans_notification(request: Request):
+async def midtrans_notification(request: Request, bg: BackgroundTasks):
     try:
-        payload = await request.json()
+        # orjson langsung dari raw bytes: parse lebih cepat dari json stdlib,
+        # dan body mentah yang sama dipakai untuk verifikasi signature
+        body = await request.body()
+        payload = orjson.loads(body)
         raw_order_id = str(payload.get("order_id", ""))
-        
+
+        # Verifikasi signature Midtrans SEBELUM menyentuh database sama sekali:
+        # sha512(order_id + status_code + gross_amount + server_key), dibandingkan
+        # constant-time. Webhook palsu/replay ditolak dengan biaya mikrodetik.
+        expected_signature = hashlib.sha512(
+            (
+                raw_order_id
+                + str(payload.get("status_code", ""))
+                + str(payload.get("gross_amount", ""))
+                + MIDTRANS_SERVER_KEY
+            ).encode()
+        ).hexdigest()
+        if not hmac.compare_digest(expected_signature, str(payload.get("signature_key", ""))):
+            raise HTTPException(status_code=401, detail="Invalid signature")
+
         # Bersihkan Order ID (jika format "15-173...")
         if "-" in raw_order_id:
             order_id = raw_order_id.split("-")[0]
@@ -144,31 +271,67 @@ async def midtrans_notification(request: Request):
         
         if not order_id:
             raise HTTPException(status_code=400, detail="Missing order_id")
+        order_id_int = int(order_id)
+
+        logger.debug(f"Webhook Masuk: Order {order_id_int} | Status: {transaction_status}")
 
-        print(f"🔔 Webhook Masuk: Order {order_id} | Status: {transaction_status}")
+        supabase = await get_async_supabase()
 
-        journal_recorded = False
+        # FAST-PATH: status transien (pending dsb.) tidak mengubah status order,
+        # jadi jangan bayar satu UPDATE ke orders per event hanya untuk no-op.
+        # Event-nya tetap dicatat untuk audit + deteksi pengiriman ulang.
+        if transaction_status not in SETTLED and transaction_status not in FAILED:
+            duplicate = await _record_webhook_event(
+                supabase, transaction_id, order_id_int, transaction_status
+            )
+            return {"status": "ok", "processed": False, "duplicate": duplicate}
+
+        journal_scheduled = False
         new_status = transaction_status
 
-        if transaction_status in ["capture", "settlement"]:
+        if transaction_status in SETTLED:
             new_status = "settle"
-            # Panggil fungsi pencatatan
-            journal_recorded = record_sales_journal(int(order_id)) 
-            
-        elif transaction_status in ["deny", "expire", "cancel"]:
+            # Jalankan pencatatan SETELAH response 200 terkirim, supaya Midtrans
+            # tidak timeout menunggu 5-10 round-trip Supabase lalu retry lagi
+            bg.add_task(record_sales_journal, order_id_int)
+            journal_scheduled = True
+
+        elif transaction_status in FAILED:
             new_status = "failed"
-            
+
         # Update Status Order
-        supabase.table("orders").update({
+        await supabase.table("orders").update({
             "status": new_status,
-            "midtrans_order_id": transaction_id 
-        }).eq("id", int(order_id)).execute()
+            "midtrans_order_id": transaction_id
+        }).eq("id", order_id_int).execute()
+
+        # Event baru dicatat SETELAH update di atas sukses; kalau update gagal,
+        # handler menjawab 500 tanpa mencatat event sehingga retry Midtrans
+        # tidak akan di-skip sebagai duplikat dan status order tidak hilang.
+        duplicate = await _record_webhook_event(
+            supabase, transaction_id, order_id_int, transaction_status
+        )
 
-        return {"status": "ok", "journal_processed": journal_recorded}
+        return {"status": "ok", "journal_scheduled": journal_scheduled, "duplicate": duplicate}
 
-    except Exception as e:
-        print(f"❌ Webhook Error: {e}")
+    except HTTPException:
+        # Jangan bungkus 401/400 menjadi 500
+        raise
+    except Exception:
+        logger.exception("Webhook Error")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 if __name__ == "__main__":
-    uvicorn.run("webhook_server:app", host="0.0.0.0", port=8080)
+    # uvloop + httptools memangkas overhead event loop & parsing HTTP;
+    # beberapa worker supaya call Supabase yang lambat tidak memblokir webhook
+    # lain (di container, Dockerfile memakai gunicorn + UvicornWorker)
+    uvicorn.run(
+        "webhook_server:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8080")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", str((os.cpu_count() or 1) * 2))),
+        timeout_keep_alive=30,
+        limit_concurrency=1000,
+    )